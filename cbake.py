@@ -1,16 +1,24 @@
 #!/usr/bin/python
-from functools import reduce
+from functools import lru_cache
+from itertools import islice
 import os
 import sys
-import struct
 from sys import stderr
 
-from multiprocessing.pool import ThreadPool
-from threading import Lock
+from multiprocessing import Pool
+from threading import Event
 
 # TODO relative inclusion of header files in include/ from src/ not supported by vscode
 
+import hashlib
+import io
 import json
+import mmap
+import pickle
+import re
+import shlex
+import subprocess
+from collections import deque
 from dataclasses import dataclass
 import time
 from typing import Callable, Dict, List, Tuple
@@ -18,42 +26,57 @@ from fnmatch import fnmatch
 
 CBAKE_DEP_FILE = ".cbake-dependencies.txt"
 CBAKE_DEP_FILE_DBG = ".cbake-dependencies-dbg.txt"
-
+CBAKE_OBJ_HASH_FILE = ".cbake-obj-hashes.txt"
+CBAKE_OBJ_HASH_FILE_DBG = ".cbake-obj-hashes-dbg.txt"
+
+# converts `/` to the path separator of the platform, chosen once at import
+if os.sep == "/":
+    def norm_sep(p): return p
+else:
+    def norm_sep(p): return p.replace("/", os.sep)
+
+def is_clean_path(p):
+    # no empty, `.` or `..` components, also with either separator on Windows
+    return all(c not in ("", os.curdir, os.pardir) for c in norm_sep(p).split(os.sep))
+
+# joins and normalizes paths, the behavior of the former tokenizer is kept:
+#   pjoin("src", "a/./b.h")  -> "src/a/b.h"
+#   pjoin("src", "a/../b.h") -> "src/b.h"
+#   pjoin("src", "a/..")     -> "src"
+#   pjoin("a", "..")         -> ""
+#   pjoin("src", "../../x")  -> FileNotFoundError, leaves the project directory
+@lru_cache(maxsize=8192)
 def pjoin(*paths):
+    if all(is_clean_path(p) for p in paths if p): # fast path
+        return os.sep.join(norm_sep(p) for p in paths if p)
 
-    path = []
-
-    for p in paths:
-        if os.sep != "/": p = p.replace("/", os.sep)
-        for d in p.split("/"):
-            if not d:
-                pass
-            elif d == ".":
-                pass
-            elif d == "..":
-                try:
-                    path.pop()
-                except IndexError:
-                    raise FileNotFoundError
-            else:
-                path.append(d)
+    path = os.path.normpath(os.sep.join(norm_sep(p) for p in paths if p))
+
+    if path == os.curdir:
+        return ""
+    if path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise FileNotFoundError
 
-    return os.sep.join(path)
+    return path
 
 def eprint(*args, end='\n', file=sys.stderr):
     print(*args, end=end, file=file)
 
 class LazyPrinter:
-    content : str
+    _parts : List[str]
     print : Callable
 
     def __init__(self, print=eprint):
-        self.content = ""
+        self._parts = []
         self.print = print
 
     def __call__(self, *args, sep=None, end='\n'):
         if sep is None: sep = ' '
-        self.content += sep.join(args) + end
+        self._parts.append(sep.join(args) + end)
+
+    @property
+    def content(self) -> str:
+        return "".join(self._parts)
 
     def print_all(self):
         self.print(self.content, end="")
@@ -62,33 +85,65 @@ class LazyPrinter:
 CC = "gcc"
 CXX = "g++"
 
+# worker processes are replaced after this many tasks to bound their memory
+WORKER_MAX_TASKS = 64
+
+
+SOURCE_EXTENSIONS = (".c", ".cpp")
 
 FILE_NOT_FOUND = object()
 FILE_AMBIGUOUS = object()
+NOT_CACHED = object()
 
 
+# Pointer bit width: 32 for 32-bit; 64 for 64-bit eg x64
+PTR_BITS = "64" if sys.maxsize > 2**32 else "32"
+
 def system_flags():
     return {
         "WIN": os.name == 'nt',
-        str(struct.calcsize("P") * 8): True # Pointer bit width: 32 for 32-bit; 64 for 64-bit eg x64
+        PTR_BITS: True
     }
 
 class CBakeCtx:
     cbake_dep_file : str
+    cbake_obj_hash_file : str
     flags : Dict[str, bool]
+    flag_idx : Dict[str, int]
+    flag_bits : int
     out_prefix : str
     path_cache : Dict[str, str]
+    conditional_cache : Dict[str, Tuple[int, int, str]]
+    mtime_cache : Dict[str, float]
+    extra_mtime_cache : Dict[str, float]
+    source_paths : List[str]
 
     # set separately, json object
     settings : object
 
+    # set by resolve_flags, after the flags are final
+    c_flags_argv : List[str]
+    cxx_flags_argv : List[str]
+    linker_flags_argv : List[str]
+
+    # (is_c, src_dir) -> compile command template, see compile_cmd_template
+    cmd_templates : Dict[Tuple[bool, str], Tuple[List[str], int]]
+
     def __init__(self):
         self.cbake_dep_file = CBAKE_DEP_FILE
+        self.cbake_obj_hash_file = CBAKE_OBJ_HASH_FILE
 
         # used by the special syntax:
         #  `@!WIN&64: -opt`, this enables `-opt` only if the current platform
         #  is not Windows and the current platform is a 64 bit system
-        self.flags = system_flags()
+        self.flags = {}
+
+        # flag -> bit index, flag_bits has the bits of all active flags set
+        self.flag_idx = {}
+        self.flag_bits = 0
+
+        for flag, value in system_flags().items():
+            self.set_flag(flag, value)
 
         # prefix to all output files
         self.out_prefix = ""
@@ -97,26 +152,50 @@ class CBakeCtx:
         # None if the file is cannot be found
         self.path_cache = {}
 
+        # element -> parsed conditional element, see parse_conditional_element
+        self.conditional_cache = {}
+
+        # effective_path -> mtime of all files in src/ and include/
+        # filled by scan_files
+        self.mtime_cache = {}
+        # effective_path -> mtime of files that were not found by scan_files,
+        # but by file_exists, e.g. out-of-tree or differently cased includes
+        self.extra_mtime_cache = {}
+        # paths of all source files in src/, filled by scan_files
+        self.source_paths = []
+
+        self.cmd_templates = {}
+
+    def flag_mask(self, flag):
+        if flag not in self.flag_idx:
+            self.flag_idx[flag] = len(self.flag_idx)
+        return 1 << self.flag_idx[flag]
+
+    def set_flag(self, flag, value=True):
+        self.flags[flag] = value
+        if value: self.flag_bits |= self.flag_mask(flag)
+        else:     self.flag_bits &= ~self.flag_mask(flag)
+
 class ParallelWorkerCtx:
-    _thread_pool : ThreadPool
-    _stop : bool
-    _lock : Lock
+    _pool : Pool
+    _process_count : int
+    _stop : Event
 
-    def __init__(self, thread_count):
-        self._thread_pool = ThreadPool(thread_count)
-        self._stop = False
-        self._lock = Lock()
+    def __init__(self, process_count):
+        # worker processes, such that the parsing of the compiler output
+        # is not serialized by the GIL
+        self._pool = Pool(process_count, maxtasksperchild=WORKER_MAX_TASKS)
+        self._process_count = process_count
+        self._stop = Event()
 
     def raise_stop(self):
-        with self._lock:
-            # Finish pending tasks, the following would cancel them:
-            #if not self._stop:
-            #    self._thread_pool.terminate()
-            self._stop = True
+        # Finish pending tasks, the following would cancel them:
+        #if not self._stop.is_set():
+        #    self._pool.terminate()
+        self._stop.set()
 
     def is_stop_raised(self):
-        with self._lock:
-            return self._stop
+        return self._stop.is_set()
 
     def execute(self, func, tasks):
         def yield_func():
@@ -124,7 +203,21 @@ class ParallelWorkerCtx:
                 if self.is_stop_raised(): return
                 yield t
 
-        return self._thread_pool.imap_unordered(func, yield_func())
+        # tasks are sent to the workers in chunks to amortize the
+        # per task overhead, same heuristic as Pool.map
+        chunksize = max(1, len(tasks) // (4 * self._process_count))
+
+        # func needs to be picklable, i.e. a module level function
+        return self._pool.imap_unordered(func, yield_func(), chunksize)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+def execute_tasks(pctx, func, tasks):
+    # pctx is None for a single threaded build
+    if pctx is None: return map(func, tasks)
+    return pctx.execute(func, tasks)
 
 
 
@@ -149,15 +242,10 @@ def pretty_format_csv(attrs : List[Tuple[str,str,str,str]], l : List[object]):
     ]
     all_cells = [attr_names] + cells
 
-    all_cell_len = ((len(cell) for cell in row) for row in all_cells)
-
-    hd_max = lambda a, b: map(lambda aibi: max(*aibi), zip(a, b))
-
-    widths = tuple(reduce(
-        hd_max,
-        all_cell_len,
-        (0,) * len(attrs)
-    ))
+    widths = [len(name) for name in attr_names]
+    for row in cells:
+        for i, cell in enumerate(row):
+            if len(cell) > widths[i]: widths[i] = len(cell)
 
 
     format_str = " ; ".join(
@@ -173,19 +261,34 @@ def pretty_format_csv(attrs : List[Tuple[str,str,str,str]], l : List[object]):
 
 
 
+def file_exists(ctx : CBakeCtx, path):
+    if path in ctx.mtime_cache or path in ctx.extra_mtime_cache: return True
+
+    # not found by the exact name, it may still exist with a different
+    # letter case on a case insensitive file system (Windows, macOS)
+    # or outside of src/ and include/
+    try:    ctx.extra_mtime_cache[path] = os.path.getmtime(path)
+    except OSError: return False
+    return True
+
+def file_mtime(ctx : CBakeCtx, path):
+    f_time = ctx.mtime_cache.get(path)
+    if f_time is not None: return f_time
+
+    if not file_exists(ctx, path): raise FileNotFoundError(path)
+    return ctx.extra_mtime_cache[path]
+
 # Files could be moved between src/ and include/!
 # this needs to be handled correctly
 #
 # files with the same name in the src/ and include/
 # directories are not allowed
-def get_effective_path_(path):
-    global has_invalid_includes
-
+def get_effective_path_(ctx : CBakeCtx, path):
     src_path = pjoin("src", path)
     inc_path = pjoin("include", path)
 
-    in_src     = os.path.exists(src_path)
-    in_include = os.path.exists(inc_path)
+    in_src     = file_exists(ctx, src_path)
+    in_include = file_exists(ctx, inc_path)
 
     if in_src and in_include and src_path != inc_path:
         return FILE_AMBIGUOUS
@@ -196,11 +299,11 @@ def get_effective_path_(path):
     return FILE_NOT_FOUND
 
 def get_effective_path_s(ctx : CBakeCtx, path):
-    try:    return ctx.path_cache[path]
-    except: pass
+    epath = ctx.path_cache.get(path, NOT_CACHED)
+    if epath is not NOT_CACHED: return epath
 
-    epath = get_effective_path_(path)
-    ctx.path_cache[path] = epath
+    epath = get_effective_path_(ctx, path)
+    ctx.path_cache[sys.intern(path)] = epath
     return epath
 
 def get_effective_path(ctx : CBakeCtx, path):
@@ -214,26 +317,37 @@ def dbg(locals_dict):
         eprint(f"{k+':':20} {v}")
 
 
-def conditional_element(ctx : CBakeCtx, s: str) -> str:
-    if s.startswith('@'):
-        s = s[1:]
+# parses `@A&!B: value` into (mask of required flags, mask of forbidden flags, value)
+def parse_conditional_element(ctx : CBakeCtx, s: str) -> Tuple[int, int, str]:
+    if not s.startswith('@'):
+        return 0, 0, s
 
-        flag_end = s.find(':')
-        flag_list = s[:flag_end].split('&')
+    s = s[1:]
 
-        for flag in flag_list:
-            flag = flag.strip()
-            negated = flag.startswith('!')
-            if negated: flag = flag[1:].strip()
+    flag_end = s.find(':')
+    flag_list = s[:flag_end].split('&')
 
-            result = flag in ctx.flags and ctx.flags[flag]
-            if negated: result = not result
-            if not result:
-                return ""
+    required = forbidden = 0
+    for flag in flag_list:
+        flag = flag.strip()
+        if flag.startswith('!'):
+            forbidden |= ctx.flag_mask(flag[1:].strip())
+        else:
+            required |= ctx.flag_mask(flag)
 
-        return s[flag_end+1:]
-    else:
-        return s
+    return required, forbidden, s[flag_end+1:]
+
+
+def conditional_element(ctx : CBakeCtx, s: str) -> str:
+    # each distinct element is only parsed once
+    cond = ctx.conditional_cache.get(s)
+    if cond is None:
+        cond = ctx.conditional_cache[s] = parse_conditional_element(ctx, s)
+
+    required, forbidden, value = cond
+    if (ctx.flag_bits & required) == required and not (ctx.flag_bits & forbidden):
+        return value
+    return ""
 
 
 def collect_args(ctx : CBakeCtx, str_or_list) -> str:
@@ -241,38 +355,109 @@ def collect_args(ctx : CBakeCtx, str_or_list) -> str:
     else: return " ".join(map(lambda s: conditional_element(ctx, s), str_or_list))
 
 
-def read_dep_file(ctx : CBakeCtx):
-    file_times = {}
-    file_includes = {}
+# the settings do not change during a build, the arguments are collected once
+def resolve_flags(ctx : CBakeCtx):
+    # TODO remove split:
+    ctx.c_flags_argv      = collect_args(ctx, ctx.settings.get("c-flags", "")).split()
+    ctx.cxx_flags_argv    = collect_args(ctx, ctx.settings.get("cxx-flags", "")).split()
+    ctx.linker_flags_argv = collect_args(ctx, ctx.settings.get("linker-flags", "")).split()
+
+
+# first line of the dependency file, followed by the pickled dependencies
+DEP_FILE_HEADER = b"CBake dependencies 5\n"
+
+# the resolved include paths are stored together with the digest of all
+# file names in src/ and include/, they are valid as long as it does not change,
+# only resolutions to scanned files are stored, the ones found by the
+# fallback of file_exists depend on files outside of the scanned trees
+def read_dep_file(ctx : CBakeCtx, files_digest):
+    try:
+        with open(ctx.cbake_dep_file, "rb") as f:
+            # files of an older format are ignored
+            if f.readline() == DEP_FILE_HEADER:
+                file_times, file_hashes, file_includes, stamp, (path_digest, path_cache) = pickle.load(f)
+                if path_digest == files_digest:
+                    mtime_cache = ctx.mtime_cache
+                    ctx.path_cache.update((fn, efn) for fn, efn in path_cache.items() if efn in mtime_cache)
+                return file_times, file_hashes, file_includes, stamp
+    except FileNotFoundError: pass
+    # a damaged file is ignored like a missing one, everything is rescanned
+    except (EOFError, pickle.UnpicklingError, ValueError): pass
+
+    # file_times, file_hashes, file_includes, stamp
+    return {}, {}, {}, None
+
+
+def write_dep_file(ctx : CBakeCtx, files_digest, file_times, file_hashes, file_includes, stamp):
+    # FILE_NOT_FOUND and FILE_AMBIGUOUS cannot be stored, as they are compared by identity,
+    # these are not in mtime_cache, just like files outside of src/ and include/
+    mtime_cache = ctx.mtime_cache
+    path_cache = {fn: efn for fn, efn in ctx.path_cache.items() if efn in mtime_cache}
+    # written to a temporary file first, such that an interrupted
+    # build does not leave a truncated dependency file behind
+    tmp_file = ctx.cbake_dep_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(DEP_FILE_HEADER)
+        pickle.dump(
+            (file_times, file_hashes, file_includes, stamp, (files_digest, path_cache)),
+            f, protocol=5
+        )
+    os.replace(tmp_file, ctx.cbake_dep_file)
+
+
+def names_digest(names):
+    return hashlib.blake2b("\0".join(sorted(names)).encode(), digest_size=16).hexdigest()
+
+# (digest of all file names with their mtimes, digest of source names, extra files)
+# if it is unchanged since the last successful build, nothing needs to be done
+#
+# extra_times are the mtimes of the dependencies outside of the scanned files,
+# see file_exists, their names are part of the stamp to check them again
+def build_stamp(ctx : CBakeCtx, sources, extra_times):
+    times = sorted(ctx.mtime_cache.items()) + sorted(extra_times.items())
+    files = "\0".join(f"{fn}\1{mtime!r}" for fn, mtime in times)
+    files_digest = hashlib.blake2b(files.encode(), digest_size=16).hexdigest()
+    return files_digest, names_digest(sources), tuple(sorted(extra_times))
+
+def extra_file_times(extra_files):
+    extra_times = {}
+    for fn in extra_files:
+        try:    extra_times[fn] = os.path.getmtime(fn)
+        except OSError: pass # removed, changes the stamp
+    return extra_times
+
+
+def read_obj_hash_file(ctx : CBakeCtx):
+    obj_hashes = {}
     try:
-        with open(ctx.cbake_dep_file) as f:
-            for l in f.readlines():
+        with open(ctx.cbake_obj_hash_file) as f:
+            for l in f:
                 l = l.strip()
 
                 if not l: continue
 
-                fn, time, *includes = map(str.strip, l.split())
-                time = float(time)
-                file_times[fn] = time
-                def parse_include(inc):
-                    at_pos = inc.rfind('@')
-                    ln = int(inc[at_pos+1:])
-                    return inc[:at_pos], ln
-                file_includes[fn] = list(map(parse_include, includes))
-                                  # [parse_include(inc) for inc in includes]
+                ofn, h = l.split()
+                obj_hashes[ofn] = h
     except FileNotFoundError: pass
 
-    return file_times, file_includes
+    return obj_hashes
 
 
-def write_dep_file(ctx : CBakeCtx, file_times, file_includes):
+def write_obj_hash_file(ctx : CBakeCtx, obj_hashes):
 
-    files = sorted(file_times.keys())
-    with open(ctx.cbake_dep_file, "w") as f:
-        for fn in files:
-            s_time = str(file_times[fn])
-            s_includes = " ".join(f"{fname}@{ln}" for fname, ln in file_includes[fn])
-            print(f"{fn} {s_time} {s_includes}", file = f)
+    files = sorted(obj_hashes.keys())
+    with open(ctx.cbake_obj_hash_file, "w") as f:
+        for ofn in files:
+            print(f"{ofn} {obj_hashes[ofn]}", file = f)
+
+
+def file_hash(filename):
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.blake2b(digest_size=16).hexdigest()
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.blake2b(mm, digest_size=16).hexdigest()
 
 
 def get_err_msg(efn):
@@ -282,59 +467,44 @@ def get_err_msg(efn):
         return "Ambiguous file include"
 
 
-def get_includes(filename, efilename):
-    with open(efilename) as f:
-        for ln, rl in enumerate(f.readlines()):
-            l = rl.strip()
-
-            if not l: continue
-            if l[0] != '#': continue
-
-            l = l[1:].strip()
+re_include = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*"([^"\r\n]+)"', re.MULTILINE)
 
-            if not l.startswith("include"): continue
+def get_includes(filename, efilename):
+    with open(efilename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: return # cannot mmap empty files
 
-            l = l[len("include"):].strip()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # line numbers are counted incrementally between matches
+            ln = 1
+            pos = 0
+            for m in re_include.finditer(mm):
+                ln += mm[pos:m.start()].count(b"\n")
+                pos = m.start()
 
-            if not l[0] == '"': continue
+                fname = m.group(1).decode()
 
-            l = l[1:]
-            end = l.find('"')
-            fname = l[:end]
-            rfname = fname
+                fname = norm_sep(fname)
 
-            if os.sep != "/":
-                fname = fname.replace("/", os.sep)
+                if fname.startswith("."):
+                    fname = os.path.split(filename)[0] + "/" + fname
 
-            if fname.startswith("."):
-                fname = os.path.split(filename)[0] + "/" + fname
+                yield sys.intern(fname), ln
 
-            #fnd = rl.find(rfname)
-            #if msg := get_err_msg(efn):
-            #    herefile = efilename # pjoin(os.getcwd(), efilename)
-            #    eprint(
-            #        f"{herefile}:{ln+1}:{fnd+1-1}: fatal error: {rfname}: {msg}\n" +
-            #        f" {rl.rstrip()}\n" +
-            #        " "*(fnd+1-1) + "^" + "~"*(2-1+len(rfname)),
-            #        end = "\n\n"
-            #    )
 
-            yield fname, ln+1
+def read_line(filename, ln):
+    # stops reading at the requested line
+    with open(filename) as f:
+        return next(islice(f, ln-1, None), "")
 
 
 def check_includes(ctx, filename, efilename, includes):
-    contents = None
     success = True
     for fname, ln in includes:
         efn = get_effective_path_s(ctx, fname)
         if msg := get_err_msg(efn):
-            if contents is None:
-                with open(efilename) as f:
-                    contents = f.readlines()
-
             success = False
 
-            l = contents[ln-1]
+            l = read_line(efilename, ln)
             a = l.find('"')
             b = l.find('"', a+1)
             rfname = l[a+1:b]
@@ -350,17 +520,29 @@ def check_includes(ctx, filename, efilename, includes):
     return success
 
 
-def get_included_files(includes):
-    return set(fname for fname, location in includes)
-
+# yields the directory entries of all files, these provide the file type
+# and on Windows the mtime without an additional stat call
 def collect_files(path):
-    lst = os.listdir(path)
-    for fn in lst:
-        p = pjoin(path, fn)
-        if os.path.isdir(p):
-            yield from collect_files(p)
-        else:
-            yield p
+    with os.scandir(path) as it:
+        for e in it:
+            if e.is_dir():
+                yield from collect_files(e.path)
+            else:
+                yield e
+
+def scan_tree(ctx : CBakeCtx, d):
+    for e in collect_files(d):
+        # e.g. dangling symlinks like editor lock files
+        try:    ctx.mtime_cache[e.path] = e.stat().st_mtime
+        except OSError: continue
+
+        if d == "src" and e.name.endswith(SOURCE_EXTENSIONS):
+            ctx.source_paths.append(e.path)
+
+def scan_files(ctx : CBakeCtx):
+    scan_tree(ctx, "src")
+    try:    scan_tree(ctx, "include")
+    except FileNotFoundError: pass # include/ is optional
 
 def fnmatchlist(filename, patterns):
     if isinstance(patterns, str): return fnmatch(filename, patterns)
@@ -368,66 +550,100 @@ def fnmatchlist(filename, patterns):
 
 def collect_sources(ctx):
     pattern_exclude = ctx.settings.get("exclude-source", [])
-    for f in collect_files("src"):
-        if os.path.splitext(f)[1] in [".c", ".cpp"]:
-            if fnmatchlist(f, pattern_exclude): continue
-            assert f[0:4] == "src" + os.sep
-            yield f[4:]
-
-def discover(ctx : CBakeCtx, file_times, file_includes, sources):
+    for f in ctx.source_paths:
+        if fnmatchlist(f, pattern_exclude): continue
+        yield sys.intern(f[4:])
+
+# executed in a worker process
+# includes is None if the content did not change
+def scan_includes_task(args):
+    fn, efn, f_time, old_hash = args
+    h = file_hash(efn)
+    if h == old_hash: return fn, efn, f_time, h, None
+    return fn, efn, f_time, h, list(get_includes(fn, efn))
+
+def discover(ctx : CBakeCtx, pctx, file_times, file_hashes, file_includes, sources):
     success = True
 
+    # the new dependencies differ from the old ones
+    dirty = False
+
 
     # rebuilding: automatically removing unreferenced files
     new_file_times = {}
+    new_file_hashes = {}
     new_file_includes = {}
 
 
 
-    known_files = set(file_times.keys())
-
     src_files = set(sources)
-    cur_files = set(src_files) # copy
-    checked_files = set()
+    cur_files = list(src_files)
+    checked_files = set(src_files) # files that have been queued once
+
+    # local bindings for the loops below
+    mtime_cache = ctx.mtime_cache
+    is_checked = checked_files.__contains__
+    add_checked = checked_files.add
 
     modified_files = set()
 
-    # forward pass: find included files
+    # forward pass: find included files,
+    # processed level by level, such that the files of a level can be scanned in parallel
     while cur_files:
-        next_files = set()
-        checked_files |= cur_files
+        next_files = []
 
+        level_files = {} # fn -> (efn, f_time, hash, includes)
+        to_scan = []
         for fn in cur_files:
             efn = get_effective_path_s(ctx, fn)
             assert get_err_msg(efn) == None
 
-            f_time = os.path.getmtime(efn)
+            f_time = mtime_cache.get(efn)
+            # resolved outside of the scanned files, see file_exists
+            if f_time is None: f_time = file_mtime(ctx, efn)
 
-            if fn not in known_files or \
+            # each file is only visited once, known files are the files of the last run
+            if fn not in file_times or \
                f_time > file_times[fn]:
 
-                #print(f"{fn} modified")
-
-                includes = list(get_includes(fn, efn))
-                modified_files |= {fn}
+                to_scan.append((fn, efn, f_time, file_hashes.get(fn)))
             else:
+                level_files[fn] = efn, f_time, file_hashes[fn], file_includes[fn]
+
+        # the files with a newer mtime of the current level are scanned in parallel,
+        # a file is only considered modified if its content hash changed
+        for fn, efn, f_time, h, includes in execute_tasks(pctx, scan_includes_task, to_scan):
+            if includes is None:
                 includes = file_includes[fn]
+            else:
+                #print(f"{fn} modified")
+                # interned strings are not preserved when returned from a worker process
+                includes = [(sys.intern(ff), ln) for ff, ln in includes]
+                modified_files.add(fn)
+            level_files[fn] = efn, f_time, h, includes
 
+        for fn, (efn, f_time, h, includes) in level_files.items():
             if not check_includes(ctx, fn, efn, includes):
                 success = False
 
             else:
 
-                included_files = get_included_files(includes)
-                next_files |= included_files - checked_files
+                for ff, lineno in includes:
+                    if not is_checked(ff):
+                        add_checked(ff)
+                        next_files.append(ff)
                 new_file_includes[fn] = includes
 
                 new_file_times[fn] = f_time
-                known_files |= {fn}
+                new_file_hashes[fn] = h
+                # hash and includes are only rescanned if the mtime changed
+                if f_time != file_times.get(fn): dirty = True
 
 
         cur_files = next_files
 
+    # files were dropped
+    if len(new_file_times) != len(file_times): dirty = True
 
     # middle pass: create backpointers, invert graph
     included_from = {}
@@ -435,66 +651,61 @@ def discover(ctx : CBakeCtx, file_times, file_includes, sources):
         for ff, lineno in includes:
             #if ff in modified_files:
             #    print(f"{fn} includes {ff}")
-            if ff in included_from:
-                included_from[ff] |= {fn}
-            else:
-                included_from[ff] = {fn}
+            included_from.setdefault(ff, set()).add(fn)
 
 
     # backward pass: propagate modifications
     recompile = set()
 
-    cur_files = modified_files
-    propagated_files = set()
+    queue = deque(modified_files)
+    propagated_files = set(modified_files) # files that have been queued once
 
-    while cur_files:
-        next_files = set()
-        propagated_files |= cur_files
+    while queue:
+        fn = queue.popleft()
 
-        for fn in cur_files:
-            if fn in src_files:
-                recompile |= {fn}
+        if fn in src_files:
+            recompile.add(fn)
 
-            if fn in included_from: # there are files including this file
-                next_files |= included_from[fn] - propagated_files
-
-        cur_files = next_files
+        # files including this file
+        for ff in included_from.get(fn, ()):
+            if ff not in propagated_files:
+                propagated_files.add(ff)
+                queue.append(ff)
 
 
     #dbg(locals())
 
 
-    return new_file_times, new_file_includes, recompile, success
+    return new_file_times, new_file_hashes, new_file_includes, recompile, dirty, success
 
 
 
 
-# behaves like os.system, but improves output messages for vscode
-def exec_compiler(tprint, cmd) -> Tuple[int, int, int]: # exit_code, errors, warnings
-    #cmd = " ".join(cmd)
-    #return os.system(cmd)
+def esc(cmds):
+    return f"\x1b[{cmds}"
 
-    def esc(cmds):
-        return f"\x1b[{cmds}"
+COLORS = {
+    "error":   esc('91m'),
+    "warning": esc('95m'),
+    "note":    esc('96m'),
+}
 
-    from subprocess import Popen, PIPE
-    import re
+re_color = re.compile("(error|warning|note):")
 
-    proc = Popen(cmd, stderr=PIPE)
+def colorize(l):
+    return re_color.sub(lambda m: COLORS[m.group(1)] + m.group(0) + esc('0m'), l)
 
-    def colorize(l):
-        l = l.replace("error:", esc('91m')+"error:"+esc('0m'))
-        l = l.replace("warning:", esc('95m')+"warning:"+esc('0m'))
-        l = l.replace("note:", esc('96m')+"note:"+esc('0m'))
-        return l
+re_msg = re.compile("^(?P<file>.*):(?P<line>\\d+):(?P<colm>\\d+):\\s+(?P<sevr>error|warning|note):\\s+(?P<what>.*)$")
 
-    regexpr_msg  = re.compile("^(.*):(\\d+):(\\d+):\\s+(error|warning):\\s+(.*)$")
-    regexpr_note = re.compile("^(.*):(\\d+):(\\d+):\\s+(note):\\s+(.*)$")
-    re_file = 1
-    re_line = 2
-    re_colm = 3
-    re_sevr = 4
-    re_what = 5
+# buffer size of the compiler output
+READ_BUFFER_SIZE = 65536
+
+# behaves like os.system, but improves output messages for vscode
+def exec_compiler(tprint, cmd) -> Tuple[int, int, int]: # exit_code, errors, warnings
+    #cmd = " ".join(cmd)
+    #return os.system(cmd)
+
+    proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, bufsize=READ_BUFFER_SIZE)
 
     cur_file = None
     cur_line = None
@@ -509,62 +720,82 @@ def exec_compiler(tprint, cmd) -> Tuple[int, int, int]: # exit_code, errors, war
         tprint()
 
     errors = warnings = 0
-    while True:
-        l = proc.stderr.readline().decode()
-        if l == "":
-            returncode = proc.poll()
-            if returncode is not None:
-                print_prev()
-                return (returncode, errors, warnings)
-        else:
-            if (m := re.match(regexpr_msg, l)) is not None:
+
+    def handle_line(l):
+        nonlocal cur_file, cur_line, cur_colm, cur_sevr, cur_what
+        nonlocal errors, warnings
+
+        if (m := re_msg.match(l)) is not None:
+            if m.group("sevr") != "note":
                 print_prev()
-                cur_file = m.group(re_file)
-                cur_line = m.group(re_line)
-                cur_colm = m.group(re_colm)
-                cur_sevr = m.group(re_sevr)
-                cur_what = m.group(re_what)
+                cur_file, cur_line, cur_colm, cur_sevr, cur_what = \
+                    m.group("file", "line", "colm", "sevr", "what")
 
                 if cur_sevr == "error": errors += 1
                 if cur_sevr == "warning": warnings += 1
 
-            if (m := re.match(regexpr_note, l)) is not None:
-                if "in expansion" in m.group(re_what):
-                    cur_file = m.group(re_file)
-                    cur_line = m.group(re_line)
-                    cur_colm = m.group(re_colm)
-                    # keep cur_sevr and cur_what
+            elif "in expansion" in m.group("what"):
+                cur_file, cur_line, cur_colm = m.group("file", "line", "colm")
+                # keep cur_sevr and cur_what
 
-            tprint(colorize(l), end="")
+        tprint(colorize(l), end="")
 
+    # lines are split and decoded by the buffered text wrapper
+    for l in io.TextIOWrapper(proc.stderr, encoding="utf-8", errors="replace", newline=""):
+        handle_line(l)
 
+    returncode = proc.wait()
+    print_prev()
+    return (returncode, errors, warnings)
 
 
-def compile_object_file(tprint, ctx : CBakeCtx, fn) -> CompilationResult:
+
+
+def object_filename(ctx : CBakeCtx, fn):
     fnn, ext = os.path.splitext(fn)
-    if ext == ".c":
-        comp_flags = collect_args(ctx, ctx.settings.get("c-flags", ""))
+    return f"obj/{ctx.out_prefix + fnn}.o"
+
+# returns (cmd, src_slot), the output file is placed at cmd[3]
+# and the source file at cmd[src_slot]
+def compile_cmd_template(ctx : CBakeCtx, is_c, src_dir):
+    key = (is_c, src_dir)
+    if (template := ctx.cmd_templates.get(key)) is not None:
+        return template
+
+    if is_c:
+        comp_flags = ctx.c_flags_argv
         comp  = CC
     else:
-        comp_flags = collect_args(ctx, ctx.settings.get("cxx-flags", ""))
+        comp_flags = ctx.cxx_flags_argv
         comp  = CXX
 
-    ofn = f"obj/{ctx.out_prefix + fnn}.o"
-
-    # OK to be multithreaded, syscalls are synchronized
-    os.makedirs(os.path.split(ofn)[0], exist_ok=True)
-
     # add include path relative to the include directory with the same name
-    include_path_rel = "-I" + pjoin("include", os.path.split(fn)[0])
+    include_path_rel = "-I" + pjoin("include", src_dir)
     include_path     = "-Iinclude"
     include_paths = [include_path] if include_path_rel == include_path else [include_path_rel, include_path]
 
-    # TODO remove split:
-    comp_flags = comp_flags.split()
+    cmd = [comp, '-c', '-o', None, *include_paths, None, *comp_flags]
+    template = ctx.cmd_templates[key] = (cmd, 4 + len(include_paths))
+    return template
+
+# returns (ofn, cmd), the object file and the full compiler command
+def compile_cmd(ctx : CBakeCtx, fn):
+    fnn, ext = os.path.splitext(fn)
 
-    cmd = [comp, '-c', '-o', ofn, *include_paths, f'src/{fn}', *comp_flags]
+    ofn = object_filename(ctx, fn)
 
-    tprint(' '.join(cmd))
+    template, src_slot = compile_cmd_template(ctx, ext == ".c", os.path.split(fn)[0])
+    cmd = template.copy()
+    cmd[3] = ofn
+    cmd[src_slot] = f'src/{fn}'
+    return ofn, cmd
+
+def compile_object_file(tprint, ctx : CBakeCtx, fn) -> CompilationResult:
+    ofn, cmd = compile_cmd(ctx, fn)
+    return run_compiler(tprint, ofn, cmd)
+
+def run_compiler(tprint, ofn, cmd) -> CompilationResult:
+    tprint(shlex.join(cmd))
     start = time.time()
     exit_code, errors, warnings = exec_compiler(tprint, cmd)
     elapsed = time.time() - start
@@ -577,26 +808,32 @@ def compile_object_file(tprint, ctx : CBakeCtx, fn) -> CompilationResult:
         elapsed_time=elapsed
     )
 
+# executed in a worker process, the output is returned as a string,
+# the command is built beforehand, such that the context is not sent to the workers
+def compile_task(args):
+    fn, ofn, cmd = args
+    tprint = LazyPrinter()
+    result = run_compiler(tprint, ofn, cmd)
+    return (fn, tprint.content, result)
+
 def link_executable(tprint, ctx : CBakeCtx, sources) -> CompilationResult:
     has_cxx = False
     object_files = []
     for fn in sources:
         fnn, ext = os.path.splitext(fn)
         if ext == ".cpp": has_cxx = True
-        object_files.append(f"obj/{ctx.out_prefix + fnn}.o")
+        object_files.append(object_filename(ctx, fn))
 
-    comp_flags = collect_args(ctx, ctx.settings.get("linker-flags", ""))
+    comp_flags = ctx.linker_flags_argv
 
     if has_cxx: comp = CXX
     else:       comp = CC
 
     ofn = ctx.settings.get("program", "a.out")
 
-    # TODO remove split:
-    comp_flags = comp_flags.split()
     cmd = [comp, '-o', ctx.out_prefix + ofn, *object_files, *comp_flags]
 
-    tprint(' '.join(cmd))
+    tprint(shlex.join(cmd))
     start = time.time()
     exit_code, errors, warnings = exec_compiler(tprint, cmd)
     elapsed = time.time() - start
@@ -624,31 +861,73 @@ def program_filename(ctx : CBakeCtx, name):
     return name
 
 
+def write_build_stats(ctx : CBakeCtx, compilation_stats : List[CompilationResult]):
+    if (build_stats_file := ctx.settings.get("build-stats-file", None)) is not None:
+        with open(build_stats_file, "wt") as f:
+            compilation_stats.sort(key=lambda st: st.elapsed_time, reverse=True)
+            f.write(pretty_format_csv(
+                [
+                    ("filename",     "filename", "{}",     ""),
+                    ("exit_code",    "$?",       "{}",     ">"),
+                    ("errors",       "E",        "{}",     ">"),
+                    ("warnings",     "W",        "{}",     ">"),
+                    ("elapsed_time", "T",        "{:.3f}", ">")
+                ],
+                compilation_stats
+            ))
+
+
 def process_files(ctx : CBakeCtx):
     # 1. discover
     # 2. compile
     # 3. update dependency file
 
+    threads = ctx.settings.get("threads", os.cpu_count() or 1)
+    assert type(threads) == int
+    assert threads >= 1
+
+    resolve_flags(ctx)
+
+    program = program_filename(ctx, ctx.out_prefix + ctx.settings.get("program", "a.out"))
+
     # 1. discover
     eprint("CBake: File discovery...")
+    scan_files(ctx)
     sources = list(collect_sources(ctx))
-    file_times, file_includes = read_dep_file(ctx)
-    n_file_times, n_file_includes, recompile, success = \
-                  discover(ctx, file_times, file_includes, sources)
+    files_digest = names_digest(ctx.mtime_cache)
+    file_times, file_hashes, file_includes, stamp = read_dep_file(ctx, files_digest)
+
+    # no file was modified, added or removed since the last successful build
+    if stamp is not None and os.path.exists(program) and \
+       build_stamp(ctx, sources, extra_file_times(stamp[2])) == stamp:
+        eprint("CBake: Nothing needs to be done")
+        write_build_stats(ctx, [])
+        return True
+
+    pctx = ParallelWorkerCtx(threads) if threads > 1 else None
+
+    n_file_times, n_file_hashes, n_file_includes, recompile, dirty, success = \
+                  discover(ctx, pctx, file_times, file_hashes, file_includes, sources)
 
     if not success:
         eprint("CBake: File discovery failed")
+        if pctx is not None: pctx.close()
         return False
 
+    # the extra files are known after the discovery
+    n_stamp = build_stamp(ctx, sources, ctx.extra_mtime_cache)
+
     # 2. compile
     eprint("CBake: Object file compilation...")
     compilation_stats : List[CompilationResult] = []
 
+    # create the output directories once, instead of once per compiled file
+    obj_dirs = {os.path.split(object_filename(ctx, fn))[0] for fn in recompile}
+    for d in obj_dirs:
+        os.makedirs(d, exist_ok=True)
+
     recompiled = set()
-    threads = ctx.settings.get("threads", os.cpu_count() or 1)
-    assert type(threads) == int
-    assert threads >= 1
-    if threads == 1: # single thread build
+    if pctx is None: # single thread build
         for fn in recompile:
             result = compile_object_file(eprint, ctx, fn)
             compilation_stats.append(result)
@@ -658,15 +937,9 @@ def process_files(ctx : CBakeCtx):
 
             recompiled.add(fn)
     else:
-        pctx = ParallelWorkerCtx(threads)
-
-        def handle_task(fn):
-            tprint = LazyPrinter()
-            result = compile_object_file(tprint, ctx, fn)
-            return (fn, tprint, result)
-
-        for (fn, tprint, result) in pctx.execute(handle_task, recompile):
-            tprint.print_all()
+        tasks = [(fn, *compile_cmd(ctx, fn)) for fn in recompile]
+        for (fn, output, result) in pctx.execute(compile_task, tasks):
+            eprint(output, end="")
             compilation_stats.append(result)
             if not result.success:
                 success = False
@@ -675,19 +948,47 @@ def process_files(ctx : CBakeCtx):
 
             recompiled.add(fn)
 
+        pctx.close()
+
 
     # remove not compiled files from the list to invalidate
     not_compiled = recompile - recompiled
+    if not_compiled: dirty = True
     for fn in not_compiled:
         del n_file_times[fn]
+        del n_file_hashes[fn]
         del n_file_includes[fn]
 
 
-    if success and recompile:
+    # only link if any object file changed its content or the executable is missing,
+    # objects newer than the executable are rehashed, they may have been compiled
+    # in an earlier build that failed before linking
+    link = False
+    if success:
+        try:    program_time = os.path.getmtime(program)
+        except FileNotFoundError: program_time = None
+
+        obj_hashes = read_obj_hash_file(ctx)
+        n_obj_hashes = {}
+        for fn in sources:
+            ofn = object_filename(ctx, fn)
+            try:
+                if ofn not in obj_hashes or program_time is None or \
+                   os.path.getmtime(ofn) > program_time:
+                    n_obj_hashes[ofn] = file_hash(ofn)
+                else:
+                    n_obj_hashes[ofn] = obj_hashes[ofn]
+            except FileNotFoundError: pass # reported by the linker
+
+        link = n_obj_hashes != obj_hashes or program_time is None
+
+    if link:
         eprint("CBake: Executable linking...")
         result = link_executable(eprint, ctx, sources)
         compilation_stats.append(result)
         success = result.success
+        if success:
+            write_obj_hash_file(ctx, n_obj_hashes)
     elif success:
             eprint("CBake: Nothing needs to be done")
 
@@ -695,23 +996,12 @@ def process_files(ctx : CBakeCtx):
         eprint("CBake: Compilation failed")
 
     # 3. update dependency
-    if n_file_times != file_times or n_file_includes != file_includes:
-        write_dep_file(ctx, n_file_times, n_file_includes)
+    if not success: n_stamp = None
+    if dirty or n_stamp != stamp:
+        write_dep_file(ctx, files_digest, n_file_times, n_file_hashes, n_file_includes, n_stamp)
 
     # 4. write statistics
-    if (build_stats_file := ctx.settings.get("build-stats-file", None)) is not None:
-        with open(build_stats_file, "wt") as f:
-            compilation_stats.sort(key=lambda st: st.elapsed_time, reverse=True)
-            f.write(pretty_format_csv(
-                [
-                    ("filename",     "filename", "{}",     ""),
-                    ("exit_code",    "$?",       "{}",     ">"),
-                    ("errors",       "E",        "{}",     ">"),
-                    ("warnings",     "W",        "{}",     ">"),
-                    ("elapsed_time", "T",        "{:.3f}", ">")
-                ],
-                compilation_stats
-            ))
+    write_build_stats(ctx, compilation_stats)
 
     return success
 
@@ -789,10 +1079,11 @@ def main(argv):
 
 
     if fs.debug:
-        ctx.flags["DEBUG"] = True
+        ctx.set_flag("DEBUG")
 
         ctx.out_prefix = "dbg-"
         ctx.cbake_dep_file = CBAKE_DEP_FILE_DBG
+        ctx.cbake_obj_hash_file = CBAKE_OBJ_HASH_FILE_DBG
 
     program = ctx.settings.get("program", "a.out")
 
@@ -802,10 +1093,15 @@ def main(argv):
         # TODO delete object files
         remove(CBAKE_DEP_FILE)
         remove(CBAKE_DEP_FILE_DBG)
+        remove(CBAKE_OBJ_HASH_FILE)
+        remove(CBAKE_OBJ_HASH_FILE_DBG)
 
     if not fs.clean or fs.build:
         success = process_files(ctx)
-        if fs.test and success: success = os.system(ctx.out_prefix + program) == 0
+        if fs.test and success:
+            # run without a shell, the path makes sure the program is taken from the current directory
+            cmd = [os.path.join(os.curdir, program_filename(ctx, ctx.out_prefix + program))]
+            success = subprocess.run(cmd).returncode == 0
         return (0 if success else 1)
 
 